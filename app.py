@@ -1,104 +1,737 @@
 import gradio as gr
 import autogen
 import os
+import asyncio
 import google.generativeai as genai
-import traceback
+from google.ai import generativelanguage as glm
+import logging
+import textwrap
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from types import SimpleNamespace
+import numpy as np
+import diskcache
+from markdown_it import MarkdownIt
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "gemini-1.5-flash-latest"
+EMBEDDING_MODEL = "models/text-embedding-004"
+EMBEDDING_TIMEOUT = 30  # Seconds; callers wait less, this only frees the worker thread
+
+
+class LRUCache:
+    """A thread-safe mapping that evicts its least recently used entries beyond maxsize."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value for key, marking it as the most recently used."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def pop(self, key, default=None):
+        """Removes and returns the value for key."""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def put(self, key, value):
+        """Stores a value as the most recently used and returns the (key, value) pairs it displaced."""
+        with self._lock:
+            displaced = [(key, self._data[key])] if self._data.get(key, value) is not value else []
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                displaced.append(self._data.popitem(last=False))
+        return displaced
+
+    def prune(self, predicate):
+        """Removes every value the predicate holds for and returns the removed (key, value) pairs."""
+        with self._lock:
+            removed = [(k, v) for k, v in self._data.items() if predicate(v)]
+            for k, _ in removed:
+                del self._data[k]
+        return removed
+
+    def values(self):
+        """Returns a snapshot of the values, least recently used first."""
+        with self._lock:
+            return list(self._data.values())
+
+
+# genai.configure() is process-wide and consultations for different users run concurrently, so every
+# Gemini call goes through a client bound to that user's key. Clients are kept per key hash.
+GEMINI_CLIENT_CACHE_SIZE = 64
+_gemini_clients = LRUCache(GEMINI_CLIENT_CACHE_SIZE)
+
+
+def key_id(api_key):
+    """Returns a stable identifier for an API key that is safe to store and log."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def gemini_client(api_key):
+    """Returns the Gemini API client bound to the given API key, creating it on first use."""
+    kid = key_id(api_key)
+    client = _gemini_clients.get(kid)
+    if client is None:
+        client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+        _gemini_clients.put(kid, client)
+    return client
+
+
+class KeyBoundGeminiClient:
+    """
+    AutoGen model client that sends an agent's Gemini requests with its consultation's key.
+
+    AutoGen's built-in Gemini client calls genai.configure() before every request, which swaps
+    the key for the whole process, so concurrent consultations could run on each other's keys.
+    This client goes through gemini_client() instead. Agents name it as "model_client_cls" in
+    their config_list entry and register it with register_model_client().
+    """
+
+    def __init__(self, config, **kwargs):
+        self._client = gemini_client(config["api_key"])
+        self._model = config.get("model", MODEL_NAME)
+        # AutoGen keeps llm_config["timeout"] for OpenAI clients, so the deadline comes with the config entry
+        self._timeout = config.get("request_timeout")
+
+    def create(self, params):
+        """Sends the agent's messages to Gemini and returns the reply in the shape AutoGen expects."""
+        system, contents = [], []
+        for message in params["messages"]:
+            text = (message.get("content") or "").strip()
+            if not text:
+                continue
+            if message["role"] == "system":
+                system.append(text)
+                continue
+            role = "model" if message["role"] == "assistant" else "user"
+            if role == "user" and message.get("name"):
+                text = f"{message['name']}: {text}"  # Tells the other experts' messages apart
+            if contents and contents[-1].role == role:  # Gemini expects alternating roles
+                contents[-1].parts.append(glm.Part(text=text))
+            else:
+                contents.append(glm.Content(role=role, parts=[glm.Part(text=text)]))
+
+        request = glm.GenerateContentRequest(model=f"models/{self._model}", contents=contents)
+        if system:
+            request.system_instruction = glm.Content(parts=[glm.Part(text="\n\n".join(system))])
+        if params.get("temperature") is not None:
+            request.generation_config = glm.GenerationConfig(temperature=params["temperature"])
+        response = self._client.generate_content(request, timeout=self._timeout)
+
+        # A blocked or empty reply has no candidates
+        reply = "".join(part.text for candidate in response.candidates[:1] for part in candidate.content.parts)
+        usage = response.usage_metadata
+        return SimpleNamespace(
+            model=self._model,
+            choices=[SimpleNamespace(message=SimpleNamespace(content=reply, function_call=None, tool_calls=None), finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=usage.prompt_token_count, completion_tokens=usage.candidates_token_count,
+                                  total_tokens=usage.total_token_count),
+            cost=0.0,
+        )
+
+    def message_retrieval(self, response):
+        """Returns the text of every choice in the response."""
+        return [choice.message.content for choice in response.choices]
+
+    def cost(self, response):
+        """Returns the cost of the response; spend is not tracked by this app."""
+        return response.cost
+
+    @staticmethod
+    def get_usage(response):
+        """Returns the token usage of the response in AutoGen's format."""
+        return {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens,
+            "cost": response.cost,
+            "model": response.model,
+        }
+
+
+# --- Semantic Response Cache ---
+# Re-running the same case with unchanged agents is very common in demos and testing. A finished
+# consultation is served again only for the same scenario text (up to whitespace) and an agent
+# setup that hashes to the same key: a one-sentence edit can change the right plan for a patient.
+# A scenario whose embedding is merely close to a stored one only seeds the new discussion with
+# the stored plan.
+
+CONSULT_CACHE_DIR = "./.consult_cache"
+DEFAULT_CACHE_THRESHOLD = 0.85
+DEFAULT_CACHE_TTL_HOURS = 24
+MAX_CACHE_ENTRIES = 500
+
+CacheEntry = namedtuple("CacheEntry", "embedding key_hash scenario_hash formatted_history final_plan expires_at")
+
+
+def scenario_hash(text):
+    """Returns a hash of the scenario text that ignores whitespace differences."""
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+class SemanticCache:
+    """
+    Stores finished consultations, serves them again for the same scenario and finds the most
+    similar stored scenario for seeding.
+
+    Entries are CacheEntry tuples keyed on their key hash and scenario hash. Each one carries the
+    absolute time it expires, fixed by the lifetime of the consultation that stored it, so one
+    user's shorter Cache Lifetime never expires anybody else's entries. They are persisted with
+    diskcache, one key per entry, so they survive app restarts.
+    """
+
+    def __init__(self, directory=CONSULT_CACHE_DIR):
+        self._disk = diskcache.Cache(directory)
+        self._entries = LRUCache(MAX_CACHE_ENTRIES)  # disk key -> entry
+        self._disk.delete("entries")  # Single-key list written by earlier versions
+        loaded, now = [], time.time()
+        for k in self._disk.iterkeys():
+            if isinstance(k, str) and k.startswith("entry:"):
+                self._disk.delete(k)  # Written by earlier versions, without a scenario hash
+            elif isinstance(k, str) and k.startswith("consultation:") and (value := self._disk.get(k)) is not None:
+                loaded.append((k, CacheEntry._make(value)))
+        for disk_key, entry in sorted(loaded, key=lambda item: item[1].expires_at):
+            if entry.expires_at > now:
+                self._entries.put(disk_key, entry)
+
+    def find(self, scenario_hash, key_hash):
+        """Returns the unexpired entry for exactly this scenario and key hash, or None."""
+        entry = self._entries.get(f"consultation:{key_hash}:{scenario_hash}")
+        if entry is None or entry.expires_at <= time.time():
+            return None
+        return entry
+
+    def nearest(self, embedding, key_hash):
+        """
+        Finds the stored consultation whose scenario is most similar to the given embedding.
+
+        Only unexpired entries with the same key hash (agents, prompts, rounds, model) are considered.
+
+        Returns:
+            tuple: (similarity, entry) of the best match, or None if there is no candidate.
+        """
+        now = time.time()
+        candidates = [e for e in self._entries.values() if e.key_hash == key_hash and e.expires_at > now]
+        if not candidates:
+            return None
+
+        matrix = np.stack([e.embedding for e in candidates])
+        query = np.asarray(embedding, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        scores = np.dot(matrix, query) / np.maximum(norms, 1e-12)
+        best = int(np.argmax(scores))
+        return float(scores[best]), candidates[best]
+
+    def store(self, embedding, key_hash, scenario_hash, formatted_history, final_plan, ttl_seconds):
+        """Adds a finished consultation that expires after ttl_seconds, dropping expired and surplus entries, and writes it to disk."""
+        now = time.time()
+        entry = CacheEntry(np.asarray(embedding, dtype=np.float32), key_hash, scenario_hash, formatted_history, final_plan, now + ttl_seconds)
+        disk_key = f"consultation:{key_hash}:{scenario_hash}"  # Re-running a scenario replaces its entry
+        stale = self._entries.put(disk_key, entry)
+        stale += self._entries.prune(lambda e: e.expires_at <= now)
+
+        # Disk writes happen outside the cache's lock so lookups are never blocked by them
+        self._disk.set(disk_key, tuple(entry), expire=ttl_seconds)
+        for k, _ in stale:
+            if k != disk_key:
+                self._disk.delete(k)
+
+
+semantic_cache = SemanticCache()
+
+
+def consultation_key(max_rounds, agents, api_key):
+    """
+    Hashes everything besides the scenario that determines a consultation's outcome.
+
+    The API key is part of the hash, so cached consultations (which contain patient scenarios)
+    are only ever served back to the key that produced them.
+
+    Args:
+        max_rounds (int): The number of discussion rounds.
+        agents (list): (name, system prompt) pairs for every agent.
+        api_key (str): The Google Gemini API key of the consultation.
+    """
+    payload = {
+        "key": key_id(api_key),
+        "model": MODEL_NAME,
+        "rounds": int(max_rounds),  # Renamed when the slider went from messages to expert rounds
+        "agents": [list(a) for a in agents],
+        "history_format": "messages",  # Entries cached in the older tuple format must not be served
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _embed(text, kid):
+    """Returns the embedding of already-normalized text as a (hashable) tuple, using the key `kid`."""
+    client = _gemini_clients.get(kid)
+    if client is None:
+        # Evicted since embed_scenario looked it up; never fall back to the process-wide key
+        raise LookupError("no Gemini client for this key")
+    result = genai.embed_content(model=EMBEDDING_MODEL, content=text, client=client, request_options={"timeout": EMBEDDING_TIMEOUT})
+    return tuple(result["embedding"])
+
+
+# Memoize embeddings: in memory by default, or on disk when CACHE_DIR is set so they survive restarts
+if os.environ.get("CACHE_DIR"):
+    _embed = diskcache.Cache(os.environ["CACHE_DIR"]).memoize()(_embed)
+else:
+    _embed = lru_cache(maxsize=1024)(_embed)
+
+
+def embed_scenario(text, api_key):
+    """Returns the embedding vector of a patient scenario, ignoring case and whitespace differences."""
+    gemini_client(api_key)  # Makes sure the client for this key exists before _embed looks it up
+    return _embed(" ".join(text.split()).lower(), key_id(api_key))
+
+
+# --- Final Plan Synthesis ---
+# The moderator does not take part in the discussion. Once the experts are done, one temperature-0
+# Gemini call turns the transcript into the final plan, so an identical transcript always yields
+# the same plan. Its raw reply is cached by a hash of the transcript and the moderator's prompt.
+
+FINAL_PLAN_SENTINEL = "--- FINAL PLAN ---"
+FINAL_PLAN_CACHE_SIZE = 256
+FINAL_PLAN_TEMPLATE = """{moderator_prompt}
+
+The discussion is over. Below is the full transcript of the consultation.
+Write the final plan now. Start your message with '{sentinel}' and use the headings "Diagnosis", "Treatment", and "Follow-up".
+
+--- TRANSCRIPT ---
+{transcript}"""
+
+_final_plan_cache = LRUCache(FINAL_PLAN_CACHE_SIZE)
+
+
+def synthesize_plan(transcript_text, masoud_prompt, api_key, request_timeout):
+    """
+    Turns the expert discussion into the final plan with a single Gemini call.
+
+    Args:
+        transcript_text (str): The discussion, one "Name: message" block per turn.
+        masoud_prompt (str): The moderator's system prompt, used as the synthesis instructions.
+        api_key (str): The Google Gemini API key to make the call with.
+        request_timeout (float): Seconds to wait for Gemini's reply.
+
+    Returns:
+        str: The raw reply, or an empty string if Gemini produced none.
+    """
+    plan_key = hashlib.sha256((transcript_text + masoud_prompt).encode("utf-8")).hexdigest()
+    cached = _final_plan_cache.get(plan_key)
+    if cached is not None:
+        return cached
+
+    prompt = FINAL_PLAN_TEMPLATE.format(moderator_prompt=masoud_prompt, sentinel=FINAL_PLAN_SENTINEL, transcript=transcript_text)
+    request = glm.GenerateContentRequest(
+        model=f"models/{MODEL_NAME}",
+        contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])],
+        generation_config=glm.GenerationConfig(temperature=0),
+    )
+    response = gemini_client(api_key).generate_content(request, timeout=request_timeout)
+    # A blocked or empty reply has no candidates
+    reply = "".join(part.text for candidate in response.candidates[:1] for part in candidate.content.parts)
+
+    if reply.strip():
+        _final_plan_cache.put(plan_key, reply)
+    return reply
+
+
+# --- Parallel Group Chat ---
+
+DEFAULT_REQUEST_TIMEOUT = 15
+MAX_RETRIES = 3
+CONSULTATION_CONCURRENCY = 8
+EXPERTS_PER_CONSULTATION = 3
+
+# Blocking Gemini calls run on their own pool instead of asyncio's shared default executor, where
+# time spent waiting for a free thread would count against request_timeout. Every request carries
+# its own deadline, but a call abandoned by asyncio.wait_for keeps its thread until that deadline
+# passes, so the pool has room for every attempt of every expert of every concurrent consultation,
+# plus the embedding and final-plan calls.
+GEMINI_THREADS = CONSULTATION_CONCURRENCY * (EXPERTS_PER_CONSULTATION * (MAX_RETRIES + 1) + 2)
+_gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_THREADS, thread_name_prefix="gemini")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Runs a blocking Gemini call on the dedicated thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(_gemini_executor, partial(fn, *args, **kwargs))
+
+
+class ParallelGroupChatManager(autogen.GroupChatManager):
+    """
+    Group chat manager that lets the experts answer each round concurrently.
+
+    In every round all experts reply to the same transcript at once, so a round takes about one
+    expert's latency instead of the sum of all of them. The group chat's max_round is its message
+    budget: the opening message plus one message per expert per round, so a consultation of n
+    rounds sets it to 1 + n * len(experts).
+
+    The expert calls are not merged into one request: passing a list of contents to
+    GenerativeModel.generate_content builds a single multi-turn prompt with one answer, and
+    Gemini's batch mode is an offline job API. Dispatching the calls concurrently already
+    overlaps their round-trips, so a round costs about one RTT either way.
+
+    Every turn is bounded by request_timeout and retried with exponential backoff, so a single
+    stalled Gemini call cannot freeze the whole consultation.
+    """
+
+    def __init__(self, groupchat, request_timeout=DEFAULT_REQUEST_TIMEOUT, on_message=None, **kwargs):
+        super().__init__(groupchat=groupchat, **kwargs)
+        self.request_timeout = request_timeout
+        self.on_message = on_message  # Called with every message added to the group chat
+        # Registered last so it takes precedence over the sequential run_chat of the base class
+        self.register_reply(
+            autogen.Agent,
+            ParallelGroupChatManager.a_run_chat,
+            config=groupchat,
+            reset_config=autogen.GroupChat.reset,
+            ignore_async_in_sync_chat=True,
+        )
+
+    async def a_run_chat(self, messages=None, sender=None, config=None):
+        """Runs the consultation rounds. Registered as the manager's async reply function."""
+        groupchat = config
+        if messages is None:
+            messages = self._oai_messages[sender]
+        experts = [agent for agent in groupchat.agents if agent is not sender]
+        rounds = max(1, (groupchat.max_round - 1) // len(experts))
+
+        await self._a_relay(groupchat, sender, messages[-1]["content"], role="user")
+        for _ in range(rounds):
+            replies = await self._a_gather_turns(experts)
+            for expert, reply in zip(experts, replies):
+                if reply is not None:
+                    await expert.a_send(reply, self, request_reply=False, silent=True)
+                    await self._a_relay(groupchat, expert, reply)
+        return True, None
+
+    async def _a_gather_turns(self, experts):
+        """
+        Runs one turn of every expert concurrently.
+
+        If any turn fails (or the chat is cancelled), the other turns are cancelled and awaited
+        before the error propagates. Cancelling a turn does not stop its worker thread: the thread
+        finishes once its Gemini request returns or reaches request_timeout, and its reply is dropped.
+        By then it has already read the transcript it was given, so a later consultation on the
+        released agents never sees its reply.
+        """
+        tasks = [asyncio.ensure_future(self._a_generate_with_retry(expert)) for expert in experts]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _a_generate_with_retry(self, agent):
+        """Asks an agent for its next turn, retrying with exponential backoff when it times out."""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                # The sync reply runs on the dedicated pool; AutoGen's async one would use the default executor
+                return await asyncio.wait_for(run_blocking(agent.generate_reply, sender=self), timeout=self.request_timeout)
+            except asyncio.TimeoutError:
+                if attempt == MAX_RETRIES:
+                    raise TimeoutError(
+                        f"{agent.name} did not answer within {self.request_timeout}s after {MAX_RETRIES} retries."
+                    ) from None
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def _a_relay(self, groupchat, speaker, reply, role="assistant"):
+        """Records a speaker's message in the group chat and forwards it to everyone else."""
+        content = reply.get("content") if isinstance(reply, dict) else reply
+        message = {"role": role, "name": speaker.name, "content": content or ""}
+        groupchat.messages.append(message)
+        if self.on_message is not None:
+            self.on_message(message)
+        for agent in groupchat.agents:
+            if agent is not speaker:
+                await self.a_send({"name": speaker.name, "content": content or ""}, agent, request_reply=False, silent=True)
+
+
+# --- Manager Pool ---
+# Building an agent validates its config and sets up its LLM client, so a manager is pooled
+# together with the group chat and agents it was built with, keyed on the experts' names and
+# prompts and the LLM config. A manager is checked out of the pool for the duration of a chat,
+# so concurrent consultations never share an agent.
+
+MANAGER_POOL_SIZE = 32
+_MANAGER_POOL = LRUCache(MANAGER_POOL_SIZE)
+
+
+def get_manager(experts, llm_config):
+    """
+    Checks out an idle manager for these experts, or builds one with a fresh group chat.
+
+    Args:
+        experts (list): (name, system prompt) pairs for the experts.
+        llm_config (dict): The experts' LLM configuration.
+
+    Returns:
+        ParallelGroupChatManager: A manager whose group chat's first agent is the user proxy.
+        Hand it back with release_manager() once its chat is over.
+    """
+    key = hashlib.sha256(json.dumps({"experts": experts, "llm_config": llm_config}, sort_keys=True).encode("utf-8")).hexdigest()
+    manager = _MANAGER_POOL.pop(key)
+    if manager is not None:
+        return manager
+
+    user_proxy = autogen.UserProxyAgent(name="User_Proxy", human_input_mode="NEVER", max_consecutive_auto_reply=0, code_execution_config=False)
+    agents = [user_proxy] + [
+        autogen.ConversableAgent(name=name, system_message=prompt, llm_config=llm_config, human_input_mode="NEVER")
+        for name, prompt in experts
+    ]
+    groupchat = autogen.GroupChat(agents=agents, messages=[], max_round=len(agents))
+    manager = ParallelGroupChatManager(groupchat=groupchat, llm_config=llm_config)
+    for agent in agents[1:] + [manager]:
+        agent.register_model_client(model_client_cls=KeyBoundGeminiClient)
+    manager.pool_key = key
+    return manager
+
+
+def release_manager(manager):
+    """
+    Clears a manager's consultation and returns it to the pool, evicting the least recently used
+    ones beyond MANAGER_POOL_SIZE.
+
+    The manager, its group chat and its agents are reset right away, so idle pooled managers never
+    hold on to a patient's transcript. If an idle manager with the same key is already pooled (two
+    identical consultations ran at once), it is replaced; it owns its agents, so nothing else
+    needs to be handed back.
+    """
+    manager.on_message = None
+    manager.reset()
+    manager.groupchat.messages.clear()
+    for agent in manager.groupchat.agents:
+        agent.reset()
+    _MANAGER_POOL.put(manager.pool_key, manager)
+
+
+def format_history(chat_history):
+    """Turns agent messages into Gradio "messages" entries, titled with the speaker's name."""
+    # The user_proxy's only message is the scenario, which the caller shows up-front instead
+    return [
+        {"role": "assistant", "content": content, "metadata": {"title": msg.get('name', 'Moderator')}}
+        for msg in chat_history
+        if msg['role'] != 'user' and (content := msg.get('content', '').strip())
+    ]
+
+
+# --- Final Plan Rendering ---
+# The plan pane is plain HTML rendered once on the server, instead of gr.Markdown re-rendering
+# the plan in the browser on every streamed update. Raw HTML in model output is not passed through.
+
+_MD = MarkdownIt("commonmark", {"html": False}).enable("table")
+
+
+@lru_cache(maxsize=64)
+def render_markdown(md):
+    """Renders Markdown to HTML for the final plan pane."""
+    return _MD.render(md)
+
 
 # --- Core AutoGen Logic Wrapped in a Function ---
+
+MIN_ROUNDS = 1  # Bounds of the Discussion Rounds slider, also enforced for API calls
+MAX_ROUNDS = 5
+DEFAULT_ROUNDS = 2
+MAX_SCENARIO_CHARS = 32_000  # Sanity limit well within Gemini's context window
+
+# Dedented once here, so the indentation of the source is not sent (and billed) as prompt tokens
+_INITIAL_TMPL = textwrap.dedent("""
+    Hello team. Here is the patient case for today's consultation.
+    Please discuss your approaches to diagnosis and management based on your specialties.
+    The goal is to arrive at a consensus plan.
+    {moderator} will summarize the team's final plan after the discussion.
+
+    --- PATIENT SCENARIO ---
+    {scenario}
+""").strip()
+
+_PRIOR_PLAN_TMPL = textwrap.dedent("""
+    Prior similar-case consensus:
+    {plan}
+
+    Refine it as needed for the case below.
+""").strip()
+
+_CACHED_NOTICE = (
+    "*Served from the cache:* this discussion and plan were generated earlier for the same "
+    "scenario. Set Cache Lifetime to 0 in Settings for a fresh consultation."
+)
+
 # This function takes all the UI inputs and runs the consultation.
 
-def run_consultation(api_key, max_rounds, patient_scenario,
+async def run_consultation(api_key, max_rounds, patient_scenario,
                      james_name, james_prompt,
                      david_name, david_prompt,
                      jones_name, jones_prompt,
-                     masoud_name, masoud_prompt):
+                     masoud_name, masoud_prompt,
+                     request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                     cache_threshold=DEFAULT_CACHE_THRESHOLD,
+                     cache_ttl_hours=DEFAULT_CACHE_TTL_HOURS):
     """
-    Initializes and runs a multi-agent chat simulation using AutoGen.
+    Initializes and runs a multi-agent chat simulation using AutoGen, streaming the discussion.
 
     Args:
         api_key (str): The Google Gemini API key.
-        max_rounds (int): The maximum number of rounds for the conversation.
+        max_rounds (int): The number of discussion rounds; in each round every expert replies once,
+            having read all earlier rounds.
         patient_scenario (str): The clinical case text.
         ... (str): Names and system prompts for each agent.
+        request_timeout (float): Seconds to wait for a single agent turn before retrying it.
+        cache_threshold (float): Minimum cosine similarity for seeding the discussion with a
+            previous scenario's plan.
+        cache_ttl_hours (float): How long this consultation stays cached. 0 disables the cache.
 
-    Returns:
-        tuple: A tuple containing the formatted chat history for the chatbot UI,
-               and the extracted final plan as a Markdown string.
-               Returns an error message in case of failure.
+    Yields:
+        tuple: The formatted chat history for the chatbot UI and the final plan rendered as HTML,
+               once after every agent turn and once more when the plan is ready.
+               Yields an error message in case of failure.
     """
     if not api_key:
-        return [], "**Error: API Key is missing.** Please go to the Settings tab and enter your Google API Key."
+        yield [], render_markdown("**Error: API Key is missing.** Please go to the Settings tab and enter your Google API Key.")
+        return
     if not patient_scenario.strip():
-        return [], "**Error: Patient Scenario is empty.** Please enter the patient details to start."
+        yield [], render_markdown("**Error: Patient Scenario is empty.** Please enter the patient details to start.")
+        return
+    if len(patient_scenario) >= MAX_SCENARIO_CHARS:
+        yield [], render_markdown(f"**Error: Patient Scenario is too long.** Please keep it under {MAX_SCENARIO_CHARS:,} characters.")
+        return
+    try:
+        rounds_value = float(max_rounds)
+    except (TypeError, ValueError):
+        rounds_value = float("nan")
+    if not rounds_value.is_integer() or not MIN_ROUNDS <= rounds_value <= MAX_ROUNDS:
+        yield [], render_markdown(f"**Error: Invalid Discussion Rounds.** It must be a whole number from {MIN_ROUNDS} to {MAX_ROUNDS}.")
+        return
+    max_rounds = int(rounds_value)
+    for name, prompt in [(james_name, james_prompt), (david_name, david_prompt),
+                         (jones_name, jones_prompt), (masoud_name, masoud_prompt)]:
+        if not name.strip() or not prompt.strip():
+            yield [], render_markdown("**Error: Agent settings are incomplete.** Every agent needs a name and a system prompt in the Settings tab.")
+            return
 
+    formatted_history = []  # Kept outside the try, so an error does not wipe the streamed discussion
     try:
-        # Configure the API
-        os.environ['GOOGLE_API_KEY'] = api_key
-        genai.configure(api_key=api_key)
+        # --- SEMANTIC CACHE LOOKUP ---
+        experts = [(james_name, james_prompt), (david_name, david_prompt), (jones_name, jones_prompt)]
+        cache_key = consultation_key(max_rounds, [
+            (james_name, james_prompt), (david_name, david_prompt),
+            (jones_name, jones_prompt), (masoud_name, masoud_prompt),
+        ], api_key)
+        ttl_seconds = float(cache_ttl_hours) * 3600
+        scenario_key = scenario_hash(patient_scenario)
+        prior_plan = None
+        # The same scenario was discussed before with the same setup: serve that consultation again
+        if ttl_seconds > 0 and (hit := semantic_cache.find(scenario_key, cache_key)) is not None:
+            history = [{"role": "user", "content": patient_scenario},
+                       {"role": "assistant", "content": _CACHED_NOTICE, "metadata": {"title": "Cached consultation"}}]
+            yield history + hit.formatted_history[1:], render_markdown(f"> {_CACHED_NOTICE}\n\n{hit.final_plan}")
+            return
+        if ttl_seconds > 0:
+            try:
+                scenario_embedding = await asyncio.wait_for(run_blocking(embed_scenario, patient_scenario, api_key),
+                                                            timeout=float(request_timeout))
+            except Exception:
+                # The cache is an optimization: without an embedding, just run the consultation
+                logger.warning("scenario embedding failed, running without the cache", exc_info=True)
+                ttl_seconds = 0
+        if ttl_seconds > 0:
+            match = semantic_cache.nearest(scenario_embedding, cache_key)
+            if match is not None and match[0] >= float(cache_threshold):
+                # A near-identical case was discussed before: start from its plan with half the rounds
+                prior_plan = match[1].final_plan
+                max_rounds = max(1, max_rounds // 2)
 
         # Define LLM Configuration
-        # The key fix is adding "api_type": "google" to tell AutoGen to use the Google client, not the OpenAI client.
-        config_list_gemini = [{"model": "gemini-1.5-flash-latest", "api_key": api_key, "api_type": "google"}]
+        # The experts call Gemini through KeyBoundGeminiClient, so every request uses this consultation's key
+        config_list_gemini = [{"model": MODEL_NAME, "api_key": api_key, "model_client_cls": "KeyBoundGeminiClient",
+                               "request_timeout": float(request_timeout)}]
         llm_config = {"config_list": config_list_gemini, "temperature": 0.7, "cache_seed": None} # Set cache_seed to None for different results each time
 
-        # --- AGENT DEFINITIONS (Dynamically created from UI) ---
-        james = autogen.ConversableAgent(name=james_name, system_message=james_prompt, llm_config=llm_config, human_input_mode="NEVER")
-        david = autogen.ConversableAgent(name=david_name, system_message=david_prompt, llm_config=llm_config, human_input_mode="NEVER")
-        jones = autogen.ConversableAgent(name=jones_name, system_message=jones_prompt, llm_config=llm_config, human_input_mode="NEVER")
-        masoud = autogen.ConversableAgent(name=masoud_name, system_message=masoud_prompt, llm_config=llm_config, human_input_mode="NEVER")
-        user_proxy = autogen.UserProxyAgent(name="User_Proxy", human_input_mode="NEVER", max_consecutive_auto_reply=0, code_execution_config=False)
-
-        # --- GROUP CHAT SETUP ---
-        agents = [user_proxy, james, david, jones, masoud]
-        groupchat = autogen.GroupChat(agents=agents, messages=[], max_round=int(max_rounds)) # Ensure max_rounds is an integer
-        manager = autogen.GroupChatManager(groupchat=groupchat, llm_config=llm_config)
+        # --- GROUP CHAT SETUP (agents dynamically created from UI, reused across runs) ---
+        manager = get_manager(experts, llm_config)
+        groupchat = manager.groupchat
+        user_proxy = groupchat.agents[0]
+        groupchat.max_round = 1 + max_rounds * len(experts)  # The opening message, then one message per expert per round
+        manager.request_timeout = float(request_timeout)
+        updates = asyncio.Queue()
+        manager.on_message = updates.put_nowait
 
         # --- INITIATE CHAT ---
-        initial_message = f"""
-        Hello team. Here is the patient case for today's consultation.
-        Please discuss your approaches to diagnosis and management based on your specialties.
-        The goal is to arrive at a consensus plan.
-        {masoud_name}, please moderate and provide the final summary plan at the end.
-
-        --- PATIENT SCENARIO ---
-        {patient_scenario}
-        """
-        user_proxy.initiate_chat(manager, message=initial_message)
+        initial_message = _INITIAL_TMPL.format_map({"moderator": masoud_name, "scenario": patient_scenario})
+        if prior_plan is not None:
+            initial_message = _PRIOR_PLAN_TMPL.format_map({"plan": prior_plan}) + "\n\n" + initial_message
+
+        async def chat():
+            try:
+                await user_proxy.a_initiate_chat(manager, message=initial_message)
+            finally:
+                release_manager(manager)
+                updates.put_nowait(None)  # Tells the stream below that the chat is over
+
+        # --- STREAM THE DISCUSSION ---
+        # Each agent turn is appended to the running history, so the UI only receives the new message
+        # The messages are collected here, since the pooled group chat may be reused once released
+        chat_task = asyncio.create_task(chat())
+        chat_history = []
+        formatted_history = [{"role": "user", "content": patient_scenario}]
+        try:
+            while (message := await updates.get()) is not None:
+                chat_history.append(message)
+                formatted_history += format_history([message])
+                yield formatted_history, render_markdown("*The team is discussing the case...*")
+            await chat_task  # Re-raises any error from the chat
+        finally:
+            # Stops the discussion if the stream is closed early, e.g. when the client disconnects
+            chat_task.cancel()
 
         # --- PROCESS AND FORMAT OUTPUT ---
-        chat_history = groupchat.messages
-        formatted_history = []
-        for msg in chat_history:
-            if msg['role'] == 'user': # The user_proxy is the 'user'
-                if "PATIENT SCENARIO" in msg['content']:
-                     formatted_history.append( ("**Patient Scenario Input**", patient_scenario) )
-                continue
+        yield formatted_history, render_markdown("*Synthesizing the final plan...*")
 
-            speaker_name = msg.get('name', 'Moderator')
-            content = msg.get('content', '').strip()
-            if content:
-                formatted_history.append( (f"**{speaker_name}**", content) )
+        # Synthesize the final plan from the discussion
+        transcript_text = "\n\n".join(
+            f"{msg.get('name', 'Moderator')}: {msg['content'].strip()}"
+            for msg in chat_history
+            if msg.get('content', '').strip()
+        )
+        raw_plan = await run_blocking(synthesize_plan, transcript_text, masoud_prompt, api_key, float(request_timeout))
+        final_plan = raw_plan.strip().removeprefix(FINAL_PLAN_SENTINEL).strip()
 
-        # Extract the final plan
-        final_plan = "Final plan not generated or found in the conversation."
-        for msg in reversed(chat_history):
-            if msg.get('name') == masoud_name and "--- FINAL PLAN ---" in msg.get('content', ''):
-                final_plan = msg['content'].replace("--- FINAL PLAN ---", "").strip()
-                break
-        
-        return formatted_history, final_plan
+        if final_plan:
+            # Only consultations that reached a plan are worth serving again
+            if ttl_seconds > 0:
+                await asyncio.to_thread(semantic_cache.store, scenario_embedding, cache_key, scenario_key,
+                                        formatted_history, final_plan, ttl_seconds)
+        else:
+            final_plan = "Final plan not generated or found in the conversation."
+
+        yield formatted_history, render_markdown(final_plan)
 
     except Exception as e:
-        error_message = f"An error occurred: {str(e)}\n\n"
-        error_message += "Common issues:\n"
-        error_message += "- Invalid or expired Google API key.\n"
-        error_message += "- Ensure the model name 'gemini-1.5-flash-latest' is correct and you have access.\n"
-        error_message += "- Network connectivity issues.\n\n"
-        error_message += f"Traceback:\n{traceback.format_exc()}"
-        return [], error_message
+        logger.exception("consultation failed")
+        yield formatted_history, render_markdown(f"**Error:** {type(e).__name__}: {e}\n\nCheck server logs for details.")
 
 # --- GRADIO UI DEFINITION ---
 
+MAX_QUEUE_SIZE = 64
+
 # Default values from your script
 DEFAULT_JAMES_PROMPT = """You are Dr. James, a distinguished Professor of Pediatrics.
 Your focus is on child-specific diseases, developmental considerations, and family-centered care.
@@ -118,10 +751,9 @@ You often bring a "what would I actually do in the clinic on a busy Monday?" per
 Your tone is practical, empathetic, and direct."""
 
 DEFAULT_MASOUD_PROMPT = """You are Masoud, the moderator of this medical consultation.
-Your role is to guide the discussion, ensure all specialists contribute, and prevent the conversation from getting stuck.
-After the experts have presented their views, your primary task is to synthesize their opinions, identify points of consensus and disagreement, and formulate a clear, actionable final plan.
+You do not take part in the discussion. Once the specialists have finished, you read the full transcript and write the team's final plan.
+Synthesize their opinions, identify points of consensus and disagreement, and formulate a clear, actionable final plan.
 Do not offer your own medical opinions. Your job is to create a coherent summary of the team's conclusion.
-When you are ready to write the final plan, you MUST start your entire message with the phrase '--- FINAL PLAN ---' and nothing else.
 Format the final plan using clear headings and bullet points for sections like "Diagnosis", "Treatment", and "Follow-up". Ensure the language is easy to understand for a non-medical professional."""
 
 DEFAULT_SCENARIO = """**Patient:** A 17-year-old male.
@@ -163,11 +795,11 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
 
                 with gr.Column(scale=2):
                     gr.Markdown("### Final Synthesized Plan")
-                    final_plan_output = gr.Markdown(elem_id="final_plan_output")
+                    final_plan_output = gr.HTML(elem_id="final_plan_output")
                     copy_button = gr.Button("Copy Final Plan to Clipboard")
                     
                     gr.Markdown("### Full Discussion Transcript")
-                    chatbot_output = gr.Chatbot(label="Agent Discussion", height=500, show_copy_button=True, elem_id="chatbot")
+                    chatbot_output = gr.Chatbot(type="messages", label="Agent Discussion", height=500, show_copy_button=True, elem_id="chatbot")
 
         with gr.TabItem("Settings"):
             gr.Markdown("## Configuration")
@@ -178,12 +810,37 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
                     type="password"
                 )
                 max_rounds_slider = gr.Slider(
-                    minimum=2,
-                    maximum=10,
-                    value=5,
+                    minimum=MIN_ROUNDS,
+                    maximum=MAX_ROUNDS,
+                    value=DEFAULT_ROUNDS,
                     step=1,
-                    label="Max Conversation Rounds",
-                    info="Controls how many back-and-forth turns the agents can have."
+                    label="Discussion Rounds",
+                    info="In each round every expert replies once, after reading the earlier rounds."
+                )
+                request_timeout_slider = gr.Slider(
+                    minimum=5,
+                    maximum=120,
+                    value=DEFAULT_REQUEST_TIMEOUT,
+                    step=1,
+                    label="Request Timeout (seconds)",
+                    info="How long to wait for one agent's reply before retrying it."
+                )
+            with gr.Row():
+                cache_threshold_slider = gr.Slider(
+                    minimum=0.80,
+                    maximum=1.0,
+                    value=DEFAULT_CACHE_THRESHOLD,
+                    step=0.01,
+                    label="Similar-Case Threshold",
+                    info="How similar a scenario must be to a previous one for its plan to seed the discussion. Only identical scenarios are served from the cache."
+                )
+                cache_ttl_slider = gr.Slider(
+                    minimum=0,
+                    maximum=168,
+                    value=DEFAULT_CACHE_TTL_HOURS,
+                    step=1,
+                    label="Cache Lifetime (hours)",
+                    info="How long finished consultations are reused. Set to 0 to disable caching."
                 )
 
             gr.Markdown("---")
@@ -197,9 +854,14 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
             with gr.Accordion("3. Clinical IM Professor", open=False):
                 jones_name_input = gr.Textbox(label="Agent Name", value="Jones")
                 jones_prompt_input = gr.Textbox(label="System Prompt", lines=5, value=DEFAULT_JONES_PROMPT)
-            with gr.Accordion("4. Moderator", open=False):
+            with gr.Accordion("4. Moderator (writes the final plan)", open=False):
                 masoud_name_input = gr.Textbox(label="Agent Name", value="Masoud")
-                masoud_prompt_input = gr.Textbox(label="System Prompt", lines=5, value=DEFAULT_MASOUD_PROMPT)
+                masoud_prompt_input = gr.Textbox(
+                    label="System Prompt",
+                    lines=5,
+                    value=DEFAULT_MASOUD_PROMPT,
+                    info="Used once the discussion is over, to turn the transcript into the final plan."
+                )
 
     # --- Wire up UI components to the function ---
     run_button.click(
@@ -209,10 +871,14 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
             james_name_input, james_prompt_input,
             david_name_input, david_prompt_input,
             jones_name_input, jones_prompt_input,
-            masoud_name_input, masoud_prompt_input
+            masoud_name_input, masoud_prompt_input,
+            # Appended after the original inputs so positional API clients keep working
+            request_timeout_slider, cache_threshold_slider, cache_ttl_slider
         ],
         outputs=[chatbot_output, final_plan_output],
-        api_name="run_consultation" # Added for API usage
+        api_name="run_consultation", # Added for API usage
+        concurrency_id="llm",
+        concurrency_limit=CONSULTATION_CONCURRENCY # Consultations mostly wait on Gemini, so several can overlap
     )
     
     # JavaScript to handle the copy button
@@ -220,21 +886,22 @@ with gr.Blocks(theme=gr.themes.Soft(), css=custom_css) as demo:
         fn=None,
         inputs=[final_plan_output],
         js="""
-        (text) => {
-            const el = document.createElement('textarea');
-            // Extract text from the Markdown HTML
+        async (text) => {
+            // Extract text from the rendered plan HTML
             const tempDiv = document.createElement('div');
             tempDiv.innerHTML = text;
-            el.value = tempDiv.textContent || tempDiv.innerText || "";
-            document.body.appendChild(el);
-            el.select();
-            document.execCommand('copy');
-            document.body.removeChild(el);
-            gradio.Info('Final plan copied to clipboard!');
+            try {
+                // navigator.clipboard only exists in secure contexts (HTTPS or localhost)
+                await navigator.clipboard.writeText(tempDiv.textContent || "");
+                gradio.Info('Final plan copied to clipboard!');
+            } catch (err) {
+                gradio.Warning('Could not copy to clipboard. Open the app via HTTPS or localhost, or select the plan and copy it manually.');
+            }
         }
         """
     )
 
 
 if __name__ == "__main__":
+    demo.queue(default_concurrency_limit=CONSULTATION_CONCURRENCY, max_size=MAX_QUEUE_SIZE)
     demo.launch()
\ No newline at end of file